@@ -19,12 +19,17 @@ from __future__ import print_function
 
 import argparse
 from collections import namedtuple
+import concurrent.futures
+import functools
+import html
 import os
 from packaging import version
-from packaging.requirements import Requirement
+import pymod2pkg
 import re
 import requests
 import sys
+import tempfile
+import xml.etree.ElementTree as ET
 import yaml
 import json
 
@@ -34,16 +39,141 @@ CURRENT_MASTER = 'ussuri'
 # the host where to query for open reviews
 GERRIT_HOST = 'https://review.opendev.org'
 
+# background colors for the comment column in the html output
+COMMENT_COLORS = {
+    'unpackaged': 'yellow',
+    'needs upgrade': 'LightYellow',
+    'needs downgrade': 'red',
+    'needs downgrade (u-c)': 'red',
+    'ok': 'green',
+}
+
+# use the libyaml based loader if available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# the same version strings show up many times (releases, upper-constraints,
+# spec files, build service packages) so cache the PEP440 parsing
+_parse_version = functools.lru_cache(maxsize=4096)(version.parse)
+# version used for packages which are not found
+_V_ZERO = version.parse('0')
+
+_YAML_EXT_RE = re.compile(r'\.ya?ml$')
+# binary rpms in the build service published xml (no src rpms and no
+# internal files starting with '_')
+_RPM_NAME_RE = re.compile(r'^(?!_).+(?<!\.src)\.rpm\Z')
+# a spec.j2 template either sets the 'upstream_version' template variable
+# or has a plain Version field. The first match in the file wins
+_SPEC_VERSION_RE = re.compile(
+    r"{%\s*set upstream_version\s*=\s*(?:upstream_version\()?"
+    r"'(?P<upstream_version>.*)'(?:\))?\s*%}$"
+    r"|^Version:[ \t]*(?P<version>.*?)[ \t]*$", re.MULTILINE)
+
 V = namedtuple('V', ['release', 'upper_constraints', 'rpm_packaging_pkg',
                      'reviews', 'obs_published'])
 
 
+def _load_releases(yaml_path, cache_dir=None):
+    """get the releases list from a deliverable yaml file. If a cache_dir
+    is given, the list is stored there as json and reused as long as the
+    path, mtime and size of the yaml file are unchanged"""
+    cache_file = None
+    if cache_dir:
+        yaml_path = os.path.abspath(yaml_path)
+        st = os.stat(yaml_path)
+        source = [yaml_path, st.st_mtime_ns, st.st_size]
+        cache_file = os.path.join(cache_dir, '%s_%s.json' % (
+            os.path.basename(os.path.dirname(yaml_path)),
+            os.path.basename(yaml_path)))
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache['source'] == source:
+                return cache['releases']
+        except (OSError, ValueError, KeyError, TypeError):
+            # no (usable) cache file
+            pass
+
+    with open(yaml_path) as f:
+        data = yaml.load(f, Loader=YAML_LOADER)
+    releases = data.get('releases') or []
+
+    if cache_file:
+        _write_cache(cache_dir, cache_file,
+                     {'source': source, 'releases': releases})
+    return releases
+
+
+def _write_cache(cache_dir, cache_file, data):
+    """atomically write data as json to cache_file. Caching is best effort,
+    so a failed write is ignored"""
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+def _process_project(args, yaml_file, project_name, upper_constraints,
+                     obs_index, open_reviews):
+    """collect the versions for a single deliverable yaml file. Returns None
+    if the deliverable has no releases"""
+    releases = _load_releases(yaml_file.path, args['yaml_cache_dir'])
+    if not releases:
+        # there might be yaml files without any releases
+        return None
+    v_release = find_highest_release_version(releases)
+    # use tarball-base name if available
+    project_name_pkg = v_release['projects'][0].get('tarball-base',
+                                                    project_name)
+
+    # get version from upper-constraints.txt
+    if project_name in upper_constraints:
+        v_upper_constraints = upper_constraints[project_name]
+    else:
+        v_upper_constraints = '-'
+
+    # path to the corresponding .spec.j2 file
+    rpm_packaging_pkg_project_spec = os.path.join(
+        args['rpm-packaging-git-dir'],
+        'openstack', project_name_pkg,
+        '%s.spec.j2' % project_name_pkg)
+    v_rpm_packaging_pkg = find_rpm_packaging_pkg_version(
+        rpm_packaging_pkg_project_spec)
+
+    # version from build service published file
+    v_obs_published = find_openbuildservice_pkg_version(
+        obs_index, project_name)
+
+    # reviews for the given project
+    if project_name in open_reviews:
+        project_reviews = open_reviews[project_name]
+    else:
+        project_reviews = []
+
+    return V(_parse_version(v_release['version']),
+             v_upper_constraints,
+             v_rpm_packaging_pkg,
+             project_reviews,
+             v_obs_published)
+
+
 def _process_status(args=None):
     projects = {}
 
     upper_constraints = read_upper_constraints(
         os.path.join(args['requirements-git-dir'], 'upper-constraints.txt'))
 
+    # published packages from the build service
+    obs_index = build_obs_index(args['obs_published_xml'])
+
     # open reviews for the given release
     open_reviews = _gerrit_open_reviews_per_file(args['release'])
 
@@ -53,56 +183,37 @@ def _process_status(args=None):
                                      args['release'])
     releases_indep_yaml_dir = os.path.join(args['releases-git-dir'],
                                            'deliverables', '_independent')
-    yaml_files = [os.path.join(releases_indep_yaml_dir, f)
-                  for f in os.listdir(releases_indep_yaml_dir)]
-    yaml_files += [os.path.join(releases_yaml_dir, f)
-                   for f in os.listdir(releases_yaml_dir)]
-    for yaml_file in yaml_files:
-        project_name = re.sub('\.ya?ml$', '', os.path.basename(yaml_file))
-        # skip projects if include list is given
-        if len(args['include_projects']) and \
-           project_name not in args['include_projects']:
-            continue
-        with open(yaml_file) as f:
-            data = yaml.load(f.read())
-            if 'releases' not in data or not data['releases']:
-                # there might be yaml files without any releases
+    yaml_files = list(os.scandir(releases_indep_yaml_dir))
+    yaml_files += list(os.scandir(releases_yaml_dir))
+    # skip projects if include list is given
+    include_projects = set(args['include_projects'])
+
+    if args['yaml_cache_dir']:
+        try:
+            os.makedirs(args['yaml_cache_dir'], exist_ok=True)
+        except OSError:
+            # nothing gets cached if the directory can't be created
+            pass
+
+    # the projects are independent from each other, so process them in a
+    # thread pool. Most of the work (yaml, version and regex parsing) holds
+    # the GIL, so this mainly overlaps the file reads of the projects
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = []
+        for yaml_file in yaml_files:
+            project_name = _YAML_EXT_RE.sub('', yaml_file.name)
+            if include_projects and project_name not in include_projects:
                 continue
-            v_release = find_highest_release_version(data['releases'])
-        # use tarball-base name if available
-        project_name_pkg = v_release['projects'][0].get('tarball-base',
-                                                        project_name)
-
-        # get version from upper-constraints.txt
-        if project_name in upper_constraints:
-            v_upper_constraints = upper_constraints[project_name]
-        else:
-            v_upper_constraints = '-'
-
-        # path to the corresponding .spec.j2 file
-        rpm_packaging_pkg_project_spec = os.path.join(
-            args['rpm-packaging-git-dir'],
-            'openstack', project_name_pkg,
-            '%s.spec.j2' % project_name_pkg)
-        v_rpm_packaging_pkg = find_rpm_packaging_pkg_version(
-            rpm_packaging_pkg_project_spec)
-
-        # version from build service published file
-        v_obs_published = find_openbuildservice_pkg_version(
-            args['obs_published_xml'], project_name)
-
-        # reviews for the given project
-        if project_name in open_reviews:
-            project_reviews = open_reviews[project_name]
-        else:
-            project_reviews = []
-
-        # add both versions to the project dict
-        projects[project_name] = V(version.parse(v_release['version']),
-                                   v_upper_constraints,
-                                   v_rpm_packaging_pkg,
-                                   project_reviews,
-                                   v_obs_published)
+            futures.append((project_name, pool.submit(
+                _process_project, args, yaml_file, project_name,
+                upper_constraints, obs_index, open_reviews)))
+        # collect the results in directory order so a deliverable from the
+        # release directory still overrides an _independent one
+        for project_name, future in futures:
+            v = future.result()
+            if v is not None:
+                projects[project_name] = v
 
     include_obs = args['obs_published_xml']
     if args['format'] == 'text':
@@ -139,6 +250,10 @@ def process_args():
                                help='If non-empty, only the given '
                                'projects will be checked. '
                                'default: %(default)s')
+    parser_status.add_argument('--yaml-cache-dir',
+                               help='directory to cache the parsed '
+                               'deliverable yaml files in. If not given, '
+                               'nothing is cached')
     parser_status.add_argument('--format',
                                help='output format', choices=('text', 'html'),
                                default='text')
@@ -150,7 +265,9 @@ def process_args():
 def find_highest_release_version(releases):
     """get a list of dicts with a version key and find the highest version
     using PEP440 to compare the different versions"""
-    return max(releases, key=lambda x: version.parse(str(x['version'])))
+    if len(releases) == 1:
+        return releases[0]
+    return max(releases, key=lambda x: _parse_version(str(x['version'])))
 
 
 def _rpm_split_filename(filename):
@@ -160,16 +277,16 @@ def _rpm_split_filename(filename):
     foo-1.0-1.i386.rpm returns foo, 1.0, 1, i386
     1:bar-9-123a.ia64.rpm returns bar, 9, 123a, 1, ia64
     """
-    if filename[-4:] == '.rpm':
+    if filename.endswith('.rpm'):
         filename = filename[:-4]
 
     archIndex = filename.rfind('.')
     arch = filename[archIndex+1:]
 
-    relIndex = filename[:archIndex].rfind('-')
+    relIndex = filename.rfind('-', 0, archIndex)
     rel = filename[relIndex+1:archIndex]
 
-    verIndex = filename[:relIndex].rfind('-')
+    verIndex = filename.rfind('-', 0, relIndex)
     ver = filename[verIndex+1:relIndex]
 
     epochIndex = filename.find(':')
@@ -182,54 +299,119 @@ def _rpm_split_filename(filename):
     return name, ver, rel, epoch, arch
 
 
-def find_openbuildservice_pkg_version(published_xml, pkg_name):
-    """find the version in the openbuildservice published xml for the given
-    pkg name"""
-    import pymod2pkg
-    import xml.etree.ElementTree as ET
-
-    if published_xml and os.path.exists(published_xml):
-        with open(published_xml) as f:
-            tree = ET.fromstring(f.read())
-
-        distro_pkg_name = pymod2pkg.module2package(pkg_name, 'suse')
-        for child in tree:
-            if not child.attrib['name'].startswith('_') and \
-               child.attrib['name'].endswith('.rpm') and not \
-               child.attrib['name'].endswith('.src.rpm'):
-                (name, ver, release, epoch, arch) = _rpm_split_filename(
-                    child.attrib['name'])
-                if name == distro_pkg_name:
-                    return version.parse(ver)
-    return version.parse('0')
+def build_obs_index(published_xml):
+    """parse the openbuildservice published xml and return a dict with the
+    binary package name as key and the highest published version as value"""
+    index = dict()
+    if not published_xml:
+        return index
+    try:
+        f = open(published_xml, 'rb')
+    except FileNotFoundError:
+        return index
+    with f:
+        # stream the file and drop every entry once it is processed so the
+        # whole tree is never kept in memory
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            # only the direct children of the root element are packages
+            if depth != 1:
+                continue
+            name = elem.attrib['name']
+            if _RPM_NAME_RE.match(name):
+                (name, ver, release, epoch, arch) = _rpm_split_filename(name)
+                try:
+                    v = _parse_version(ver)
+                except version.InvalidVersion:
+                    # unrelated distro packages (e.g. openssl 1.1.1d) don't
+                    # always have PEP440 versions
+                    pass
+                else:
+                    if name not in index or v > index[name]:
+                        index[name] = v
+            root.clear()
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def _module2pkg_suse(pkg_name):
+    """map a python module name to the SUSE package name"""
+    return pymod2pkg.module2package(pkg_name, 'suse')
+
+
+def find_openbuildservice_pkg_version(obs_index, pkg_name):
+    """find the version in the openbuildservice published xml index for the
+    given pkg name"""
+    if not obs_index:
+        # nothing published (or no xml given), no need to map the name
+        return _V_ZERO
+    distro_pkg_name = _module2pkg_suse(pkg_name)
+    return obs_index.get(distro_pkg_name, _V_ZERO)
 
 
 def find_rpm_packaging_pkg_version(pkg_project_spec):
     """get a spec.j2 template and get the version"""
-    if os.path.exists(pkg_project_spec):
+    try:
         with open(pkg_project_spec) as f:
-            for l in f:
-                # if the template variable 'upstream_version' is set, use that
-                m = re.search(
-                    "{%\s*set upstream_version\s*=\s*(?:upstream_version\()?"
-                    "'(?P<version>.*)'(?:\))?\s*%}$", l)
-                if m:
-                    return version.parse(m.group('version'))
-                # check the Version field
-                m = re.search('^Version:\s*(?P<version>.*)\s*$', l)
-                if m:
-                    if m.group('version') == '{{ py2rpmversion() }}':
-                        return 'version unset'
-                    return version.parse(m.group('version'))
-        # no version in spec found
-        print('ERROR: no version in %s found' % pkg_project_spec)
-        return version.parse('0')
-    return version.parse('0')
-
-
-def _pretty_table(release, projects, include_obs):
-    from prettytable import PrettyTable
-    tb = PrettyTable()
+            data = f.read()
+    except FileNotFoundError:
+        return _V_ZERO
+    ver = None
+    if 'upstream_version' not in data:
+        # common case: without the upstream_version template variable the
+        # Version field is used, which can be found without a regex
+        if data.startswith('Version:'):
+            start = len('Version:')
+        else:
+            start = data.find('\nVersion:')
+            if start != -1:
+                start += len('\nVersion:')
+        if start != -1:
+            end = data.find('\n', start)
+            if end == -1:
+                end = len(data)
+            ver = data[start:end].strip()
+    if ver is None:
+        m = _SPEC_VERSION_RE.search(data)
+        if not m:
+            # no version in spec found
+            print('ERROR: no version in %s found' % pkg_project_spec,
+                  file=sys.stderr)
+            return _V_ZERO
+        if m.group('upstream_version') is not None:
+            return _parse_version(m.group('upstream_version'))
+        ver = m.group('version')
+    if ver == '{{ py2rpmversion() }}':
+        return 'version unset'
+    return _parse_version(ver)
+
+
+def _classify(x):
+    """return the comment for the versions of a single project"""
+    if x.rpm_packaging_pkg == 'version unset':
+        return 'ok'
+    if x.rpm_packaging_pkg == _V_ZERO:
+        return 'unpackaged'
+    if x.rpm_packaging_pkg < x.release:
+        return 'needs upgrade'
+    if x.rpm_packaging_pkg > x.release:
+        return 'needs downgrade'
+    # upper_constraints is '-' if unset or a plain string if not PEP440
+    if isinstance(x.upper_constraints, version.Version) and \
+            x.release > x.upper_constraints:
+        return 'needs downgrade (u-c)'
+    return 'ok'
+
+
+def _table(release, projects, include_obs):
+    """return the table header and the rows sorted by comment"""
     fn = ['name',
           'release (%s)' % release,
           'u-c (%s)' % release,
@@ -238,75 +420,67 @@ def _pretty_table(release, projects, include_obs):
     if include_obs:
         fn += ['obs']
     fn += ['comment']
-    tb.field_names = fn
 
+    rows = []
     for p_name, x in projects.items():
-        if x.rpm_packaging_pkg == 'version unset':
-            comment = 'ok'
-        elif x.rpm_packaging_pkg == version.parse('0'):
-            comment = 'unpackaged'
-        elif x.rpm_packaging_pkg < x.release:
-            comment = 'needs upgrade'
-        elif x.rpm_packaging_pkg == x.release:
-            if x.upper_constraints != '-' and \
-                    x.release > version.parse(x.upper_constraints):
-                comment = 'needs downgrade (u-c)'
-            comment = 'ok'
-        elif x.rpm_packaging_pkg > x.release:
-            comment = 'needs downgrade'
-        else:
-            comment = ''
+        comment = _classify(x)
         row = [p_name, x.release, x.upper_constraints, x.rpm_packaging_pkg,
                x.reviews]
         if include_obs:
             row += [x.obs_published]
         row += [comment]
+        rows.append(row)
 
-        tb.add_row(row)
-
-    return tb
+    rows.sort(key=lambda r: (r[-1], r[0]))
+    return fn, rows
 
 
 def output_text(release, projects, include_obs):
-    tb = _pretty_table(release, projects, include_obs)
-    print(tb.get_string(sortby='comment'))
+    fn, rows = _table(release, projects, include_obs)
+    lines = [fn] + [[str(c) for c in row] for row in rows]
+    widths = [max(len(line[i]) for line in lines) for i in range(len(fn))]
+    lines.insert(1, ['-' * w for w in widths])
+    for line in lines:
+        print('  '.join('%-*s' % (w, c)
+                        for c, w in zip(line, widths)).rstrip())
 
 
 def output_html(release, projects, include_obs):
-    """adjust the comment color a big with an ugly hack"""
-    from lxml import html
-    tb = _pretty_table(release, projects, include_obs)
-    s = tb.get_html_string(sortby='comment')
-    tree = html.document_fromstring(s)
-    tab = tree.cssselect('table')
-    tab[0].attrib['style'] = 'border-collapse: collapse;'
-    trs = tree.cssselect('tr')
-    for t in trs:
-        t.attrib['style'] = 'border-bottom:1pt solid black;'
-    tds = tree.cssselect('td')
-    for t in tds:
-        if t.text_content() == 'unpackaged':
-            t.attrib['style'] = 'background-color:yellow'
-        elif t.text_content() == 'needs upgrade':
-            t.attrib['style'] = 'background-color:LightYellow'
-        elif t.text_content() == ('needs downgrade' or 'needs downgrade (uc)'):
-            t.attrib['style'] = 'background-color:red'
-        elif t.text_content() == 'ok':
-            t.attrib['style'] = 'background-color:green'
-    print(html.tostring(tree))
+    """print the table as html with a colored comment column"""
+    fn, rows = _table(release, projects, include_obs)
+    tr = '<tr style="border-bottom:1pt solid black;">'
+    out = ['<html><body><table style="border-collapse: collapse;">',
+           tr + ''.join('<th>%s</th>' % html.escape(c) for c in fn) + '</tr>']
+    for row in rows:
+        comment = row[-1]
+        cells = ['<td>%s</td>' % html.escape(str(c)) for c in row[:-1]]
+        if comment in COMMENT_COLORS:
+            cells.append('<td style="background-color:%s">%s</td>' % (
+                COMMENT_COLORS[comment], html.escape(comment)))
+        else:
+            cells.append('<td>%s</td>' % html.escape(comment))
+        out.append(tr + ''.join(cells) + '</tr>')
+    out.append('</table></body></html>')
+    print('\n'.join(out))
 
 
 def read_upper_constraints(filename):
     uc = dict()
     with open(filename) as f:
-        for l in f.readlines():
-            # ignore markers for now
-            l = l.split(';')[0]
-            r = Requirement(l)
-            for s in r.specifier:
-                uc[r.name] = s.version
-                # there is only a single version in upper constraints
-                break
+        data = f.read()
+    for line in data.splitlines():
+        # only 'name===version' pins, ignore comments and markers
+        line = line.split('#', 1)[0].split(';', 1)[0].strip()
+        if not line:
+            continue
+        name, sep, ver = line.partition('==')
+        if sep:
+            ver = ver.lstrip('=').strip()
+            try:
+                uc[name.strip()] = _parse_version(ver)
+            except version.InvalidVersion:
+                # '===' allows arbitrary (non PEP440) versions
+                uc[name.strip()] = ver
     return uc
 
 